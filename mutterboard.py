@@ -1,8 +1,25 @@
+import argparse
 import configparser
+import cProfile
+import fcntl
+import hashlib
+import heapq
+import html
+import io
+import json
+import mmap
 import os
+import re
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
 import time
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Set
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import gi
 import uinput
@@ -11,7 +28,7 @@ os.environ.setdefault("GDK_BACKEND", "x11")
 
 gi.require_version("Gtk", "3.0")
 gi.require_version("Gdk", "3.0")
-from gi.repository import Gdk, GLib, Gtk
+from gi.repository import Gdk, Gio, GLib, Gtk
 
 
 KEY_MAPPING: Dict[int, str] = {
@@ -85,6 +102,7 @@ KEY_MAPPING: Dict[int, str] = {
 }
 
 LABEL_TO_KEY = {label: code for code, label in KEY_MAPPING.items()}
+KEY_BY_CODE = {code[1]: code for code in KEY_MAPPING}
 MODIFIER_KEYS = {
     uinput.KEY_LEFTSHIFT,
     uinput.KEY_RIGHTSHIFT,
@@ -140,6 +158,23 @@ SYMBOL_LABELS = {
     "/": "?",
 }
 
+# 长按弹出的候选字符
+LONG_PRESS_CHARS = {
+    "A": "àáâäåæ",
+    "C": "ç",
+    "E": "éèêë€",
+    "I": "íìîï",
+    "N": "ñ",
+    "O": "óòôöøœ",
+    "S": "ß",
+    "U": "úùûü",
+    "Y": "ýÿ",
+    "4": "€£¥¢",
+    "-": "–—→",
+    ".": "…·",
+    "=": "≠±",
+}
+
 CONFIG_TOKEN_ALIASES = {
     "SHIFT": "LEFTSHIFT",
     "CTRL": "LEFTCTRL",
@@ -172,12 +207,95 @@ THEMES = {
         "text": "#EAF6FF",
     },
 }
+THEME_DEFAULTS = {"radius": "8", "spacing": "2", "font": ""}
+THEME_COLOR_KEYS = ("bg", "key", "key_border", "accent")
+CSS_CACHE_VERSION = b"2"
+
+# 事件追踪：定长环形缓冲区，每条记录 (时间戳 ns, 类型, 键码, x, y)
+# 文件头之后是 JSON 格式的布局与快捷键设置（回放时据此重建窗口）以及文本记录引用的文本
+TRACE_CAPACITY = 8192
+TRACE_MAGIC = b"MBTR"
+TRACE_VERSION = 3
+TRACE_HEADER = struct.Struct("<4sHHII")
+TRACE_RECORD = struct.Struct("<qBxxxIff")
+
+TRACE_PRESS = 1
+TRACE_RELEASE = 2
+TRACE_MOTION = 3
+TRACE_EMIT_DOWN = 4
+TRACE_EMIT_UP = 5
+TRACE_CHAR = 6
+TRACE_CHAR_REPLACE = 7
+TRACE_TEXT = 8
+# 计时器触发：回放时按记录驱动，而不是重新计时
+TRACE_REPEAT_DELAY = 9
+TRACE_REPEAT_TICK = 10
+TRACE_CURSOR_MODE = 11
+
+TraceRecord = Tuple[int, int, int, float, float]
+
+# 按键使用统计：定长 u32 计数器直接映射到文件
+USAGE_MAGIC = b"MBUS"
+USAGE_VERSION = 1
+USAGE_HEADER = struct.Struct("<4sI")
+USAGE_KEYS = 256
+USAGE_CHORD_MASKS = 16
+USAGE_SLOTS = USAGE_KEYS * 3 + USAGE_KEYS * USAGE_CHORD_MASKS
+USAGE_FLUSH_SECONDS = 30
+USAGE_MODIFIER_BITS = {
+    uinput.KEY_LEFTSHIFT: 1,
+    uinput.KEY_RIGHTSHIFT: 1,
+    uinput.KEY_LEFTCTRL: 2,
+    uinput.KEY_RIGHTCTRL: 2,
+    uinput.KEY_LEFTALT: 4,
+    uinput.KEY_RIGHTALT: 4,
+    uinput.KEY_LEFTMETA: 8,
+    uinput.KEY_RIGHTMETA: 8,
+}
+USAGE_MODIFIER_NAMES = ("Shift", "Ctrl", "Alt", "Super")
+
+# 共享注入进程协议：每条消息 (操作, 键码)，同一轮主循环内的消息合并发送
+INJECTOR_OP = struct.Struct("<BI")
+INJECTOR_DOWN = 1
+INJECTOR_UP = 2
+INJECTOR_TAP = 3
+INJECTOR_CHAR = 4
+
+# Wayland zwp_virtual_keyboard_v1 输出后端（直接实现线协议，无额外依赖）
+WL_DISPLAY_ID = 1
+WL_KEYMAP_FORMAT_XKB_V1 = 1
+WL_CAPS_LOCK_MASK = 2
+WL_HANDSHAKE_TIMEOUT = 2.0
+WL_MODIFIER_MASKS = {
+    uinput.KEY_LEFTSHIFT: 1,
+    uinput.KEY_RIGHTSHIFT: 1,
+    uinput.KEY_LEFTCTRL: 4,
+    uinput.KEY_RIGHTCTRL: 4,
+    uinput.KEY_LEFTALT: 8,
+    uinput.KEY_RIGHTALT: 8,
+    uinput.KEY_LEFTMETA: 64,
+    uinput.KEY_RIGHTMETA: 64,
+}
+XKB_KEYMAP = (
+    "xkb_keymap {\n"
+    '    xkb_keycodes { include "evdev+aliases(qwerty)" };\n'
+    '    xkb_types { include "complete" };\n'
+    '    xkb_compat { include "complete" };\n'
+    '    xkb_symbols { include "pc+us+inet(evdev)" };\n'
+    "};\n"
+)
+
+# 字符发送方案：按帧分组的 (键码, 值)，同一帧内每个键只出现一次
+CharPlan = Tuple[Tuple[Tuple[int, int], ...], ...]
+CHAR_PLANS: Dict[str, CharPlan] = {}
+HEX_DIGIT_KEYS = {digit: LABEL_TO_KEY[digit.upper()] for digit in "0123456789abcdef"}
 
 
 @dataclass
 class RepeatState:
     delay_source: Optional[int] = None
     repeat_source: Optional[int] = None
+    show_popup: bool = False
 
 
 @dataclass
@@ -187,32 +305,1130 @@ class ModifierState:
     used_in_combo: bool = False
 
 
-class KeyboardEngine:
+@dataclass
+class InjectorClient:
+    conn: socket.socket
+    watch_source: int = 0
+    pending: bytearray = field(default_factory=bytearray)
+
+
+def file_digest(path: str) -> Optional[str]:
+    try:
+        with open(path, "rb") as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def load_layout(path: str) -> List[List[str]]:
+    # 每行一排按键，标签以空白分隔；# 开头为注释
+    try:
+        with open(path, encoding="utf-8") as fp:
+            rows = [line.split() for line in fp if line.strip() and not line.lstrip().startswith("#")]
+    except (OSError, UnicodeDecodeError):
+        return DEFAULT_LAYOUT
+    return rows or DEFAULT_LAYOUT
+
+
+def build_theme_css(theme: Dict[str, str], font_size: int, key_font_size: int) -> str:
+    radius = int(theme["radius"])
+    # 间距分到按键的左上/右下外边距，两键之间正好为 spacing
+    near = int(theme["spacing"]) // 2
+    far = int(theme["spacing"]) - near
+    font_rule = f'font-family: "{theme["font"]}";' if theme["font"] else ""
+    return f"""
+    #toplevel {{ background-color: rgb({theme['bg']}); {font_rule} }}
+    #root {{ background-color: rgb({theme['bg']}); margin: 0; padding: 0; }}
+    headerbar {{
+        background-color: rgb({theme['bg']});
+        border: 0;
+        box-shadow: none;
+        min-height: 54px;
+    }}
+    headerbar button {{
+        background-image: none;
+        background-color: rgb({theme['key']});
+        border: 1px solid rgb({theme['key_border']});
+        min-height: 46px;
+        min-width: 52px;
+        border-radius: {radius}px;
+        margin: 4px 0;  /* 垂直居中，避免贴顶 */
+    }}
+    /* 不可用按钮（如 Caps 指示器）样式与普通按钮一致 */
+    headerbar button:disabled {{
+        background-image: none;
+        background-color: rgb({theme['key']});
+        border: 1px solid rgb({theme['key_border']});
+    }}
+    headerbar .titlebutton {{
+        min-width: 56px;
+        min-height: 46px;
+        background-color: rgb({theme['key']});
+    }}
+    #combobox button.combo {{
+        background-image: none;
+        background-color: rgb({theme['key']});
+        border: 1px solid rgb({theme['key_border']});
+        min-height: 46px;
+        min-width: 90px;
+        border-radius: {radius}px;
+    }}
+    headerbar button label, #combobox button.combo label {{
+        color: {theme['text']};
+        font-size: {max(font_size - 1, 12)}px;
+        font-weight: 600;
+    }}
+    #grid {{ margin: 0; padding: 0; }}
+    .key-button,
+    button.key-button,
+    .key-button:hover,
+    button.key-button:hover,
+    .key-button:focus,
+    button.key-button:focus,
+    .key-button:checked,
+    button.key-button:checked,
+    .key-button:active,
+    button.key-button:active,
+    .key-button:backdrop {{
+        border-radius: {radius}px;
+        border: 1px solid rgb({theme['key_border']});
+        background-image: none;
+        background-color: rgb({theme['key']});
+        box-shadow: none;
+        outline: none;
+        min-height: 48px;
+        margin: {near}px {far}px {far}px {near}px;
+        padding: 0;
+    }}
+    .key-button label {{ color: {theme['text']}; font-weight: 600; font-size: {key_font_size}px; }}
+    /* CapsLock 指示器按钮样式，与 header 其他按钮一致 */
+    #caps-indicator {{
+        background-image: none;
+        background-color: rgb({theme['key']});
+        border: 1px solid rgb({theme['key_border']});
+        border-radius: {radius}px;
+        min-height: 46px;
+        min-width: 85px;          /* 宽度适配文本 */
+        margin: 4px 0;             /* 与普通按钮一致 */
+        padding: 0 8px;
+        color: {theme['text']};
+        font-size: {max(font_size - 2, 11)}px;
+        font-weight: 700;
+    }}
+    /* CapsLock 开启时的蓝色文字 */
+    #caps-indicator.caps-on {{
+        color: rgba({theme['accent']}, 1.0);
+    }}
+    #caps-indicator.caps-on label {{
+        color: rgba({theme['accent']}, 1.0);
+    }}
+    .key-button.pressed,
+    .key-button.pressed:hover,
+    .key-button.pressed:focus,
+    .key-button.pressed:active {{
+        background-color: rgba({theme['accent']}, 0.28);
+        border-color: rgba({theme['accent']}, 1.0);
+    }}
+    .key-button.cursor-mode {{
+        background-color: rgba({theme['accent']}, 0.24);
+        border-color: rgba({theme['accent']}, 1.0);
+    }}
+    .key-button.cursor-mode label {{
+        color: rgba({theme['accent']}, 1.0);
+        font-weight: 700;
+    }}
+    """
+
+
+class ThemeStore:
+    def __init__(self, theme_dir: str, cache_dir: str) -> None:
+        self.theme_dir = theme_dir
+        self.cache_dir = cache_dir
+        self.sources: Dict[str, bytes] = {}
+        self.user_themes: Set[str] = set()
+        self.refresh()
+
+    def refresh(self) -> None:
+        # 启动时只读取原始内容用于计算哈希，解析与校验推迟到编译缓存缺失时
+        sources = {name: repr(sorted(theme.items())).encode("utf-8") for name, theme in THEMES.items()}
+        user_themes: Set[str] = set()
+        try:
+            entries = sorted(os.listdir(self.theme_dir))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if not entry.endswith(".conf"):
+                continue
+            try:
+                with open(os.path.join(self.theme_dir, entry), "rb") as fp:
+                    sources[entry[:-5]] = fp.read()
+            except OSError:
+                continue
+            user_themes.add(entry[:-5])
+        self.sources = sources
+        self.user_themes = user_themes
+        self._prune_cache()
+
+    def _source_digest(self, name: str) -> str:
+        return hashlib.sha1(CSS_CACHE_VERSION + b"\0" + self.sources[name]).hexdigest()
+
+    def _prune_cache(self) -> None:
+        # 缓存文件名以主题内容摘要开头，主题修改或删除后旧文件不会再被用到
+        live = {self._source_digest(name) for name in self.sources}
+        try:
+            entries = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.endswith(".css") and entry.split("-", 1)[0] not in live:
+                try:
+                    os.unlink(os.path.join(self.cache_dir, entry))
+                except OSError:
+                    pass
+
+    def names(self) -> List[str]:
+        return list(self.sources)
+
+    def parse(self, name: str) -> Dict[str, str]:
+        if name not in self.user_themes:
+            return {**THEME_DEFAULTS, **THEMES[name]}
+
+        parser = configparser.ConfigParser()
+        parser.read_string(self.sources[name].decode("utf-8"))
+        theme = {**THEME_DEFAULTS, **parser["theme"]}
+        for key in THEME_COLOR_KEYS:
+            parts = [part.strip() for part in theme.get(key, "").split(",")]
+            if len(parts) != 3 or not all(part.isdigit() and int(part) <= 255 for part in parts):
+                raise ValueError(f"invalid {key} color {theme.get(key)!r}")
+            theme[key] = ",".join(parts)
+        if not re.fullmatch(r"#[0-9A-Fa-f]{6}", theme.get("text", "")):
+            raise ValueError(f"invalid text color {theme.get('text')!r}")
+        for key in ("radius", "spacing"):
+            if not theme[key].isdigit():
+                raise ValueError(f"invalid {key} {theme[key]!r}")
+        theme["font"] = theme["font"].strip().strip("\"'")
+        if not re.fullmatch(r"[\w .-]*", theme["font"]):
+            raise ValueError(f"invalid font {theme['font']!r}")
+        return theme
+
+    def load_provider(self, name: str, font_size: int, key_font_size: int) -> Gtk.CssProvider:
+        if name not in self.sources:
+            name = "Dark"
+        path = os.path.join(self.cache_dir, f"{self._source_digest(name)}-{font_size}-{key_font_size}.css")
+        provider = Gtk.CssProvider()
+        if os.path.exists(path):
+            try:
+                provider.load_from_path(path)
+                return provider
+            except GLib.Error:
+                pass
+
+        try:
+            theme = self.parse(name)
+        except (configparser.Error, KeyError, UnicodeDecodeError, ValueError) as exc:
+            # 回退样式不写入缓存，否则下次启动直接命中缓存，不会再提示主题无效
+            print(f"mutterboard: ignoring theme {name}: {exc}", file=sys.stderr)
+            fallback = {**THEME_DEFAULTS, **THEMES["Dark"]}
+            provider.load_from_data(build_theme_css(fallback, font_size, key_font_size).encode("utf-8"))
+            return provider
+        css = build_theme_css(theme, font_size, key_font_size).encode("utf-8")
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f"{path}.tmp", "wb") as fp:
+                fp.write(css)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            pass
+        provider.load_from_data(css)
+        return provider
+
+
+def _build_ascii_keys() -> Dict[str, Tuple[int, bool]]:
+    keys = {" ": (uinput.KEY_SPACE, False), "\n": (uinput.KEY_ENTER, False), "\t": (uinput.KEY_TAB, False)}
+    for label, key_code in LABEL_TO_KEY.items():
+        if len(label) != 1 or not label.isascii():
+            continue
+        if label.isalpha():
+            keys[label.lower()] = (key_code, False)
+            keys[label] = (key_code, True)
+        else:
+            keys[label] = (key_code, False)
+            if label in SYMBOL_LABELS:
+                keys[SYMBOL_LABELS[label]] = (key_code, True)
+    return keys
+
+
+ASCII_KEYS = _build_ascii_keys()
+
+
+def _split_frames(events: List[Tuple[int, int]]) -> CharPlan:
+    frames: List[Tuple[Tuple[int, int], ...]] = []
+    frame: List[Tuple[int, int]] = []
+    for key_code, value in events:
+        if any(key_code == queued for queued, _ in frame):
+            frames.append(tuple(frame))
+            frame = []
+        frame.append((key_code, value))
+    if frame:
+        frames.append(tuple(frame))
+    return tuple(frames)
+
+
+def char_plan(char: str) -> CharPlan:
+    plan = CHAR_PLANS.get(char)
+    if plan is not None:
+        return plan
+
+    ascii_key = ASCII_KEYS.get(char)
+    if ascii_key is not None:
+        key_code, shifted = ascii_key
+        events = [(key_code, 1), (key_code, 0)]
+        if shifted:
+            events = [(uinput.KEY_LEFTSHIFT, 1)] + events + [(uinput.KEY_LEFTSHIFT, 0)]
+    else:
+        # 非 US 字符使用 Ctrl+Shift+U 十六进制输入（GTK / IBus / Qt 通用），空格确认
+        events = [
+            (uinput.KEY_LEFTCTRL, 1),
+            (uinput.KEY_LEFTSHIFT, 1),
+            (uinput.KEY_U, 1),
+            (uinput.KEY_U, 0),
+            (uinput.KEY_LEFTSHIFT, 0),
+            (uinput.KEY_LEFTCTRL, 0),
+        ]
+        for digit in f"{ord(char):x}":
+            events += [(HEX_DIGIT_KEYS[digit], 1), (HEX_DIGIT_KEYS[digit], 0)]
+        events += [(uinput.KEY_SPACE, 1), (uinput.KEY_SPACE, 0)]
+
+    plan = _split_frames(events)
+    CHAR_PLANS[char] = plan
+    return plan
+
+
+def char_frames(char: str, held: Set[int]) -> CharPlan:
+    # 已按住的修饰键：Ctrl+Shift+U 序列前全部暂时松开、发送后按回；ASCII 字符只让 Shift 与所需一致
+    plan = char_plan(char)
+    if not held:
+        return plan
+    ascii_key = ASCII_KEYS.get(char)
+    if ascii_key is None:
+        suspended = sorted(key for key in held if key in MODIFIER_KEYS)
+    elif ascii_key[1]:
+        suspended = []
+    else:
+        suspended = sorted(key for key in held if key in SHIFT_KEYS)
+    skipped = set(held).difference(suspended)
+    if ascii_key is not None and ascii_key[1] and skipped & SHIFT_KEYS:
+        skipped.add(uinput.KEY_LEFTSHIFT)
+
+    frames: List[Tuple[Tuple[int, int], ...]] = []
+    if suspended:
+        frames.append(tuple((key_code, 0) for key_code in suspended))
+    for frame in plan:
+        kept = tuple((key_code, value) for key_code, value in frame if key_code not in skipped)
+        if kept:
+            frames.append(kept)
+    if suspended:
+        frames.append(tuple((key_code, 1) for key_code in suspended))
+    return tuple(frames)
+
+
+class UsageStats:
+    def __init__(self, path: Optional[str] = None, readonly: bool = False) -> None:
+        size = USAGE_HEADER.size + USAGE_SLOTS * 4
+        self.path = None if readonly else path
+        if path is None:
+            self.map = None
+        elif readonly:
+            self.map = self._open_readonly(path, size)
+        else:
+            self.map = self._open(path, size)
+        if self.map is None:
+            self.map = mmap.mmap(-1, size)
+            USAGE_HEADER.pack_into(self.map, 0, USAGE_MAGIC, USAGE_VERSION)
+        counters = memoryview(self.map)[USAGE_HEADER.size :].cast("I")
+        self.presses = counters[:USAGE_KEYS]
+        self.repeats = counters[USAGE_KEYS : USAGE_KEYS * 2]
+        self.cursor_steps = counters[USAGE_KEYS * 2 : USAGE_KEYS * 3]
+        # 组合键按 (修饰键掩码, 键码) 展开为一维数组
+        self.chords = counters[USAGE_KEYS * 3 :]
+
+    @staticmethod
+    def _open(path: str, size: int) -> Optional[mmap.mmap]:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return None
+        try:
+            header = os.pread(fd, USAGE_HEADER.size, 0)
+            if os.fstat(fd).st_size != size or header != USAGE_HEADER.pack(USAGE_MAGIC, USAGE_VERSION):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, USAGE_HEADER.pack(USAGE_MAGIC, USAGE_VERSION), 0)
+            return mmap.mmap(fd, size)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _open_readonly(path: str, size: int) -> mmap.mmap:
+        # 导出时只读映射，文件不符时报错而不是像 _open 那样清空重建
+        with open(path, "rb") as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(data) != size or data[: USAGE_HEADER.size] != USAGE_HEADER.pack(USAGE_MAGIC, USAGE_VERSION):
+            data.close()
+            raise ValueError("not a usage statistics file of this version")
+        return data
+
+    def record_press(self, code: int, modifier_mask: int) -> None:
+        self.presses[code] += 1
+        if modifier_mask:
+            self.chords[modifier_mask * USAGE_KEYS + code] += 1
+
+    def flush(self) -> None:
+        if self.path is not None:
+            self.map.flush()
+
+
+class EventTrace:
+    def __init__(self, capacity: int = TRACE_CAPACITY) -> None:
+        self.capacity = capacity
+        self.buffer = bytearray(TRACE_RECORD.size * capacity)
+        self.count = 0
+        self.texts: Dict[int, str] = {}
+
+    def record(self, kind: int, code: int = 0, x: float = 0.0, y: float = 0.0) -> None:
+        offset = (self.count % self.capacity) * TRACE_RECORD.size
+        TRACE_RECORD.pack_into(self.buffer, offset, time.monotonic_ns(), kind, code, x, y)
+        self.count += 1
+
+    def record_text(self, text: str) -> None:
+        # 文本长度不定，存在旁表中，记录里只保存按记录序号编排的编号
+        oldest = self.count - self.capacity + 1
+        for text_id in [text_id for text_id in self.texts if text_id < oldest]:
+            del self.texts[text_id]
+        self.texts[self.count] = text
+        self.record(TRACE_TEXT, self.count & 0xFFFFFFFF)
+
+    def dump(self, path: str, settings: Dict[str, object]) -> None:
+        stored = min(self.count, self.capacity)
+        head = (self.count % self.capacity) * TRACE_RECORD.size if self.count > self.capacity else 0
+        end = stored * TRACE_RECORD.size
+        meta = json.dumps({"settings": settings, "texts": self.texts}, ensure_ascii=False).encode("utf-8")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, stored, len(meta)))
+            fp.write(meta)
+            fp.write(self.buffer[head:end])
+            fp.write(self.buffer[:head])
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> Tuple[Dict[str, object], Dict[int, str], List[TraceRecord]]:
+        with open(path, "rb") as fp:
+            data = fp.read()
+        magic, version, record_size, count, meta_size = TRACE_HEADER.unpack_from(data, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            raise ValueError(f"unsupported trace file: {path}")
+        start = TRACE_HEADER.size + meta_size
+        meta = json.loads(data[TRACE_HEADER.size : start].decode("utf-8"))
+        texts = {int(text_id) & 0xFFFFFFFF: text for text_id, text in meta["texts"].items()}
+        return meta["settings"], texts, list(TRACE_RECORD.iter_unpack(data[start : start + count * record_size]))
+
+
+class RecordingDevice:
+    def __init__(self) -> None:
+        self.events: List[Tuple[int, int]] = []
+
+    def emit(self, key_code: int, value: int, syn: bool = True) -> None:
+        self.events.append((key_code[1], value))
+
+    def syn(self) -> None:
+        pass
+
+
+class SystemClipboard:
+    # 粘贴时由隐藏控件直接持有 CLIPBOARD 选区：目标程序取走数据时会调用 selection-get，
+    # 之后再恢复原内容；目标程序响应再慢也不会粘贴到旧内容
+    TARGETS = ("UTF8_STRING", "text/plain;charset=utf-8", "STRING", "TEXT")
+
     def __init__(self) -> None:
-        self.device = uinput.Device(list(KEY_MAPPING.keys()))
+        self.clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        self.owner = Gtk.Invisible()
+        self.owner.realize()
+        for info, target in enumerate(self.TARGETS):
+            self.owner.selection_add_target(Gdk.SELECTION_CLIPBOARD, Gdk.Atom.intern(target, False), info)
+        self.owner.connect("selection-get", self._on_selection_get)
+        self.owner.connect("selection-clear-event", self._on_selection_clear)
+        self.offered: Optional[str] = None
+        self.on_fetched: Optional[Callable[[], None]] = None
+        self.on_lost: Optional[Callable[[], None]] = None
+
+    def request_text(self, callback: Callable[..., None], user_data=None) -> None:
+        self.clipboard.request_text(callback, user_data)
+
+    def set_text(self, text: str, length: int) -> None:
+        self.on_fetched = None
+        self.on_lost = None
+        self.clipboard.set_text(text, length)
+
+    def offer(self, text: str, on_fetched: Callable[[], None], on_lost: Callable[[], None]) -> None:
+        self.offered = text
+        self.on_fetched = on_fetched
+        self.on_lost = on_lost
+        Gtk.selection_owner_set(self.owner, Gdk.SELECTION_CLIPBOARD, Gdk.CURRENT_TIME)
+
+    def _on_selection_get(self, _widget, selection_data, _info, _time) -> None:
+        if self.offered is None:
+            return
+        selection_data.set_text(self.offered, -1)
+        if self.on_fetched is not None:
+            self.on_fetched()
+
+    def _on_selection_clear(self, *_args) -> bool:
+        # 其他程序接管了剪贴板（例如用户又复制了内容）
+        self.offered = None
+        if self.on_lost is not None:
+            self.on_lost()
+        self.on_fetched = None
+        self.on_lost = None
+        return False
+
+
+class MemoryClipboard:
+    # 回放与测试时代替系统剪贴板，不改动用户的剪贴板内容；提供的文本视为立即被取走
+    def __init__(self) -> None:
+        self.text: Optional[str] = None
+
+    def request_text(self, callback: Callable[..., None], user_data=None) -> None:
+        callback(self, self.text, user_data)
+
+    def set_text(self, text: str, _length: int) -> None:
+        self.text = text
+
+    def offer(self, text: str, on_fetched: Callable[[], None], _on_lost: Callable[[], None]) -> None:
+        self.text = text
+        on_fetched()
+
+
+class MainLoopClock:
+    def now(self) -> float:
+        return time.monotonic()
+
+    def timeout_add(self, interval_ms: int, callback: Callable[..., bool], *args) -> int:
+        return GLib.timeout_add(interval_ms, callback, *args)
+
+    def source_remove(self, source_id: int) -> None:
+        GLib.source_remove(source_id)
+
+
+class VirtualClock:
+    # 回放用的虚拟时钟：计时器只在推进到记录的时间戳时触发，结果与回放时的真实耗时无关。
+    # scripted 中的回调从不自行触发，由追踪中记录的触发事件直接调用
+    def __init__(self, start_ms: int = 0) -> None:
+        self.current_ms = start_ms
+        self.queue: List[Tuple[int, int, int, Callable[..., bool], tuple]] = []
+        self.cancelled: Set[int] = set()
+        self.scripted: Set[Callable[..., bool]] = set()
+        self.next_id = 1
+
+    def now(self) -> float:
+        return self.current_ms / 1000.0
+
+    def timeout_add(self, interval_ms: int, callback: Callable[..., bool], *args) -> int:
+        source_id = self.next_id
+        self.next_id += 1
+        if callback in self.scripted:
+            return source_id
+        heapq.heappush(self.queue, (self.current_ms + interval_ms, source_id, interval_ms, callback, args))
+        return source_id
+
+    def source_remove(self, source_id: int) -> None:
+        if any(queued[1] == source_id for queued in self.queue):
+            self.cancelled.add(source_id)
+
+    def advance_to(self, target_ms: int) -> None:
+        while self.queue and self.queue[0][0] <= target_ms:
+            due, source_id, interval_ms, callback, args = heapq.heappop(self.queue)
+            if source_id in self.cancelled:
+                self.cancelled.discard(source_id)
+                continue
+            self.current_ms = due
+            if callback(*args):
+                heapq.heappush(self.queue, (due + interval_ms, source_id, interval_ms, callback, args))
+        self.current_ms = max(self.current_ms, target_ms)
+
+
+def _wl_string(value: str) -> bytes:
+    data = value.encode("utf-8") + b"\0"
+    return struct.pack("<I", len(data)) + data + b"\0" * (-len(data) % 4)
+
+
+def _wl_unpack_string(payload: bytes, offset: int) -> str:
+    (length,) = struct.unpack_from("<I", payload, offset)
+    return payload[offset + 4 : offset + 3 + length].decode("utf-8", "replace")
+
+
+class WaylandVirtualKeyboard:
+    def __init__(self) -> None:
+        display = os.environ.get("WAYLAND_DISPLAY", "wayland-0")
+        if not os.path.isabs(display):
+            display = os.path.join(os.environ.get("XDG_RUNTIME_DIR", ""), display)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.next_id = 2
+        self.outgoing = bytearray()
+        self.incoming = bytearray()
+        self.held_modifiers: Set[int] = set()
+        self.locked = 0
+        self.started = time.monotonic()
+        self.flush_source: Optional[int] = None
+        self.fallback = None
+        self.ready = False
+
+        # 握手期间限时等待，合成器无响应时抛出 socket.timeout（OSError），由调用方回退到 uinput
+        self.sock.settimeout(WL_HANDSHAKE_TIMEOUT)
+        try:
+            self.sock.connect(display)
+            self._handshake()
+        except OSError:
+            self.sock.close()
+            raise
+        self.sock.settimeout(None)
+        self.ready = True
+        GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_events)
+
+    def _handshake(self) -> None:
+        registry = self._new_id()
+        self._request(WL_DISPLAY_ID, 1, struct.pack("<I", registry))
+        advertised = self._roundtrip(registry)
+        if "wl_seat" not in advertised or "zwp_virtual_keyboard_manager_v1" not in advertised:
+            raise ConnectionError("compositor does not offer zwp_virtual_keyboard_manager_v1")
+        seat = self._bind(registry, advertised["wl_seat"], "wl_seat", 1)
+        manager_name = advertised["zwp_virtual_keyboard_manager_v1"]
+        manager = self._bind(registry, manager_name, "zwp_virtual_keyboard_manager_v1", 1)
+        self.keyboard = self._new_id()
+        self._request(manager, 0, struct.pack("<II", seat, self.keyboard))
+        self._upload_keymap()
+        self._roundtrip(registry)
+
+    def _new_id(self) -> int:
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def _request(self, object_id: int, opcode: int, args: bytes = b"") -> None:
+        self.outgoing += struct.pack("<II", object_id, (8 + len(args)) << 16 | opcode) + args
+
+    def _bind(self, registry: int, name: int, interface: str, version: int) -> int:
+        object_id = self._new_id()
+        args = struct.pack("<I", name) + _wl_string(interface) + struct.pack("<II", version, object_id)
+        self._request(registry, 0, args)
+        return object_id
+
+    def _upload_keymap(self) -> None:
+        # 键位表只在连接时上传一次，文件描述符通过 SCM_RIGHTS 传递
+        data = XKB_KEYMAP.encode("utf-8") + b"\0"
+        fd = os.memfd_create("mutterboard-keymap", os.MFD_CLOEXEC)
+        try:
+            os.write(fd, data)
+            self.flush()
+            header = struct.pack("<II", self.keyboard, 16 << 16 | 0)
+            socket.send_fds(self.sock, [header + struct.pack("<II", WL_KEYMAP_FORMAT_XKB_V1, len(data))], [fd])
+        finally:
+            os.close(fd)
+
+    def _pop_message(self) -> Optional[Tuple[int, int, bytes]]:
+        if len(self.incoming) < 8:
+            return None
+        object_id, size_opcode = struct.unpack_from("<II", self.incoming)
+        size = size_opcode >> 16
+        if len(self.incoming) < size:
+            return None
+        payload = bytes(self.incoming[8:size])
+        del self.incoming[:size]
+        return object_id, size_opcode & 0xFFFF, payload
+
+    def _check_error(self, object_id: int, opcode: int, payload: bytes) -> None:
+        if object_id == WL_DISPLAY_ID and opcode == 0:
+            _, code = struct.unpack_from("<II", payload)
+            raise ConnectionError(f"wayland protocol error {code}: {_wl_unpack_string(payload, 8)}")
+
+    def _roundtrip(self, registry: int) -> Dict[str, int]:
+        callback = self._new_id()
+        self._request(WL_DISPLAY_ID, 0, struct.pack("<I", callback))
+        self.flush()
+        advertised: Dict[str, int] = {}
+        while True:
+            message = self._pop_message()
+            if message is None:
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ConnectionError("wayland compositor closed the connection")
+                self.incoming.extend(data)
+                continue
+            object_id, opcode, payload = message
+            self._check_error(object_id, opcode, payload)
+            if object_id == callback and opcode == 0:
+                return advertised
+            if object_id == registry and opcode == 0:
+                (name,) = struct.unpack_from("<I", payload)
+                advertised.setdefault(_wl_unpack_string(payload, 4), name)
+
+    def _on_events(self, _fd, condition) -> bool:
+        try:
+            data = self.sock.recv(4096) if condition & GLib.IO_IN else b""
+        except OSError:
+            data = b""
+        if not data:
+            self._fail("lost connection to wayland compositor")
+            return False
+        self.incoming.extend(data)
+        message = self._pop_message()
+        while message is not None:
+            try:
+                self._check_error(*message)
+            except ConnectionError as exc:
+                # 协议错误后合成器会断开连接
+                self._fail(str(exc))
+                return False
+            message = self._pop_message()
+        return True
+
+    def _fail(self, reason: str) -> None:
+        # 连接失效后改由 uinput 发送，并按回仍按住的修饰键，避免之后的按键全部丢失
+        if self.fallback is not None:
+            return
+        self.sock.close()
+        self.outgoing.clear()
+        try:
+            self.fallback = uinput.Device(list(KEY_MAPPING.keys()))
+        except OSError as exc:
+            print(f"mutterboard: {reason}; cannot fall back to uinput ({exc}), keys are not sent", file=sys.stderr)
+            self.fallback = RecordingDevice()
+            return
+        print(f"mutterboard: {reason}, switching to uinput", file=sys.stderr)
+        for key_code in sorted(self.held_modifiers):
+            self.fallback.emit(key_code, 1)
+
+    def emit(self, key_code: int, value: int, syn: bool = True) -> None:
+        if self.fallback is not None:
+            self.fallback.emit(key_code, value, syn)
+            return
+        timestamp = int((time.monotonic() - self.started) * 1000) & 0xFFFFFFFF
+        self._request(self.keyboard, 1, struct.pack("<III", timestamp, key_code[1], 1 if value else 0))
+        mask = WL_MODIFIER_MASKS.get(key_code)
+        if mask is not None or key_code == uinput.KEY_CAPSLOCK:
+            # 虚拟键盘的修饰键状态需由客户端自行上报
+            if mask is None:
+                if value:
+                    self.locked ^= WL_CAPS_LOCK_MASK
+            elif value:
+                self.held_modifiers.add(key_code)
+            else:
+                self.held_modifiers.discard(key_code)
+            depressed = 0
+            for held in self.held_modifiers:
+                depressed |= WL_MODIFIER_MASKS[held]
+            self._request(self.keyboard, 2, struct.pack("<IIII", depressed, 0, self.locked, 0))
+        if syn:
+            self.syn()
+
+    def syn(self) -> None:
+        # 线协议没有帧的概念：同一轮主循环内的所有按键请求合并为一次发送
+        if self.fallback is not None:
+            self.fallback.syn()
+        elif self.flush_source is None:
+            self.flush_source = GLib.idle_add(self._flush_idle, priority=GLib.PRIORITY_HIGH)
+
+    def _flush_idle(self) -> bool:
+        self.flush_source = None
+        self.flush()
+        return False
+
+    def flush(self) -> None:
+        if not self.outgoing or self.fallback is not None:
+            return
+        try:
+            self.sock.sendall(self.outgoing)
+        except OSError as exc:
+            if not self.ready:
+                raise
+            self._fail(f"cannot write to wayland compositor ({exc})")
+        self.outgoing.clear()
+
+
+def create_output_device(backend: str = "auto"):
+    if backend in ("auto", "wayland") and os.environ.get("WAYLAND_DISPLAY"):
+        try:
+            return WaylandVirtualKeyboard()
+        except OSError:
+            # 自动模式下静默回退；只有显式指定 --backend wayland 时才报错
+            if backend == "wayland":
+                raise
+    elif backend == "wayland":
+        raise ConnectionError("WAYLAND_DISPLAY is not set")
+    return uinput.Device(list(KEY_MAPPING.keys()))
+
+
+class KeyboardEngine:
+    def __init__(self, device=None, trace: Optional[EventTrace] = None) -> None:
+        self.device = device if device is not None else uinput.Device(list(KEY_MAPPING.keys()))
+        self.trace = trace
         self.down_keys: Set[int] = set()
 
+    def _emit(self, key_code: int, value: int) -> None:
+        self.device.emit(key_code, value)
+        if self.trace is not None:
+            self.trace.record(TRACE_EMIT_DOWN if value else TRACE_EMIT_UP, key_code[1])
+
     def set_key_state(self, key_code: int, pressed: bool) -> None:
         is_down = key_code in self.down_keys
         if pressed and not is_down:
-            self.device.emit(key_code, 1)
+            self._emit(key_code, 1)
             self.down_keys.add(key_code)
         elif not pressed and is_down:
-            self.device.emit(key_code, 0)
+            self._emit(key_code, 0)
             self.down_keys.discard(key_code)
 
     def tap_key(self, key_code: int) -> None:
-        self.device.emit(key_code, 1)
-        self.device.emit(key_code, 0)
+        self._emit(key_code, 1)
+        self._emit(key_code, 0)
+
+    def emit_char(self, char: str) -> None:
+        for frame in char_frames(char, self.down_keys):
+            for key_code, value in frame:
+                self.device.emit(key_code, value, syn=False)
+                if self.trace is not None:
+                    self.trace.record(TRACE_EMIT_DOWN if value else TRACE_EMIT_UP, key_code[1])
+            self.device.syn()
+
+
+def injector_socket_path() -> str:
+    return os.path.join(GLib.get_user_runtime_dir(), "mutterboard.sock")
+
+
+class InjectorServer:
+    def __init__(self, path: str, backend: str = "auto") -> None:
+        self.path = path
+        # 两个 --shared 窗口同时启动时会各自拉起注入进程，锁文件保证只有一个继续运行
+        self.lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._remove_stale_socket(path)
+        except (BlockingIOError, RuntimeError):
+            os.close(self.lock_fd)
+            raise RuntimeError(f"another injector is already running on {path}") from None
+        self.engine = KeyboardEngine(device=create_output_device(backend))
+        self.clients: Dict[int, InjectorClient] = {}
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen()
+        GLib.io_add_watch(self.listener.fileno(), GLib.IO_IN, self._on_accept)
+
+    @staticmethod
+    def _remove_stale_socket(path: str) -> None:
+        # 只删除已无进程监听的残留套接字；其他错误留给 bind 报告
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return
+        except FileNotFoundError:
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"injector already listening on {path}")
+
+    def _on_accept(self, _fd, _condition) -> bool:
+        conn, _ = self.listener.accept()
+        client = InjectorClient(conn=conn)
+        client.watch_source = GLib.io_add_watch(
+            conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_client_data
+        )
+        self.clients[conn.fileno()] = client
+        # 新窗口连接时同步当前修饰键状态
+        snapshot = b"".join(
+            INJECTOR_OP.pack(INJECTOR_DOWN, key[1]) for key in self.engine.down_keys if key in MODIFIER_KEYS
+        )
+        if snapshot:
+            self._send(client, snapshot)
+        return True
+
+    def _on_client_data(self, fd: int, condition) -> bool:
+        client = self.clients.get(fd)
+        if client is None:
+            return False
+        try:
+            data = client.conn.recv(4096) if condition & GLib.IO_IN else b""
+        except OSError:
+            data = b""
+        if not data:
+            self._drop_client(fd)
+            return False
+
+        client.pending.extend(data)
+        usable = len(client.pending) - len(client.pending) % INJECTOR_OP.size
+        changes = bytearray()
+        for op, code in INJECTOR_OP.iter_unpack(bytes(client.pending[:usable])):
+            if op == INJECTOR_CHAR:
+                if code <= 0x10FFFF:
+                    self.engine.emit_char(chr(code))
+                continue
+            key_code = KEY_BY_CODE.get(code)
+            if key_code is None:
+                continue
+            if op == INJECTOR_TAP:
+                self.engine.tap_key(key_code)
+                continue
+            pressed = op == INJECTOR_DOWN
+            was_down = key_code in self.engine.down_keys
+            self.engine.set_key_state(key_code, pressed)
+            if key_code in MODIFIER_KEYS and was_down != pressed:
+                changes += INJECTOR_OP.pack(op, code)
+        del client.pending[:usable]
+
+        if changes:
+            for other_fd, other in list(self.clients.items()):
+                if other_fd != fd:
+                    self._send(other, bytes(changes))
+        return True
+
+    def _send(self, client: InjectorClient, data: bytes) -> None:
+        try:
+            client.conn.sendall(data)
+        except OSError:
+            GLib.source_remove(client.watch_source)
+            self._drop_client(client.conn.fileno())
+
+    def _drop_client(self, fd: int) -> None:
+        client = self.clients.pop(fd, None)
+        if client is not None:
+            client.conn.close()
+        if not self.clients:
+            for key_code in list(self.engine.down_keys):
+                self.engine.set_key_state(key_code, False)
+
+    def close(self) -> None:
+        for fd in list(self.clients):
+            self._drop_client(fd)
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        os.close(self.lock_fd)
+
+
+class RemoteEngine:
+    def __init__(self, path: str, backend: str = "auto", trace: Optional[EventTrace] = None) -> None:
+        self.path = path
+        self.backend = backend
+        self.sock: Optional[socket.socket] = open_injector_socket(path, backend)
+        self.trace = trace
+        self.down_keys: Set[int] = set()
+        self.modifier_listener: Optional[Callable[[int, bool], None]] = None
+        self.status_listener: Optional[Callable[[Optional[str]], None]] = None
+        self.outgoing = bytearray()
+        self.incoming = bytearray()
+        self.flush_source: Optional[int] = None
+        self.retry_at = 0.0
+        GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_data)
+
+    def _send(self, op: int, key_code: int) -> None:
+        self._send_raw(op, key_code[1])
+
+    def _send_raw(self, op: int, code: int) -> None:
+        self.outgoing += INJECTOR_OP.pack(op, code)
+        if self.flush_source is None:
+            self.flush_source = GLib.idle_add(self._flush, priority=GLib.PRIORITY_HIGH)
+
+    def _flush(self) -> bool:
+        self.flush_source = None
+        data = bytes(self.outgoing)
+        self.outgoing.clear()
+        if self.sock is None and not self._reconnect():
+            return False
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            if self._reconnect():
+                try:
+                    self.sock.sendall(data)
+                except OSError:
+                    self._disconnect("lost connection to injector")
+        return False
+
+    def _reconnect(self) -> bool:
+        # 注入进程退出后重新连接（必要时重新拉起），失败时在窗口中提示，稍后按键时再试
+        if self.sock is not None:
+            self._disconnect(None)
+        if time.monotonic() < self.retry_at:
+            return False
+        try:
+            sock = open_injector_socket(self.path, self.backend)
+        except RuntimeError as exc:
+            self.retry_at = time.monotonic() + 5
+            self._disconnect(str(exc))
+            return False
+        # 新的注入进程没有按键状态，先补发本窗口仍按住的键
+        snapshot = b"".join(INJECTOR_OP.pack(INJECTOR_DOWN, key[1]) for key in self.down_keys)
+        try:
+            sock.sendall(snapshot)
+        except OSError:
+            sock.close()
+            self._disconnect("lost connection to injector")
+            return False
+        self.sock = sock
+        self.incoming.clear()
+        GLib.io_add_watch(sock.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._on_data)
+        if self.status_listener is not None:
+            self.status_listener(None)
+        return True
+
+    def _disconnect(self, error: Optional[str]) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if error is not None:
+            print(f"mutterboard: {error}", file=sys.stderr)
+            if self.status_listener is not None:
+                self.status_listener(error)
+
+    def _record(self, key_code: int, value: int) -> None:
+        if self.trace is not None:
+            self.trace.record(TRACE_EMIT_DOWN if value else TRACE_EMIT_UP, key_code[1])
+
+    def set_key_state(self, key_code: int, pressed: bool) -> None:
+        # 注入进程持有权威状态，始终转发，由其去重
+        self._send(INJECTOR_DOWN if pressed else INJECTOR_UP, key_code)
+        if pressed and key_code not in self.down_keys:
+            self.down_keys.add(key_code)
+            self._record(key_code, 1)
+        elif not pressed and key_code in self.down_keys:
+            self.down_keys.discard(key_code)
+            self._record(key_code, 0)
+
+    def tap_key(self, key_code: int) -> None:
+        self._send(INJECTOR_TAP, key_code)
+        self._record(key_code, 1)
+        self._record(key_code, 0)
+
+    def emit_char(self, char: str) -> None:
+        self._send_raw(INJECTOR_CHAR, ord(char))
+        for frame in char_frames(char, self.down_keys):
+            for key_code, value in frame:
+                self._record(key_code, value)
+
+    def _on_data(self, fd: int, condition) -> bool:
+        if self.sock is None or fd != self.sock.fileno():
+            return False
+        try:
+            data = self.sock.recv(4096) if condition & GLib.IO_IN else b""
+        except OSError:
+            data = b""
+        if not data:
+            print("mutterboard: lost connection to injector, reconnecting", file=sys.stderr)
+            self._reconnect()
+            return False
+
+        self.incoming.extend(data)
+        usable = len(self.incoming) - len(self.incoming) % INJECTOR_OP.size
+        for op, code in INJECTOR_OP.iter_unpack(bytes(self.incoming[:usable])):
+            key_code = KEY_BY_CODE.get(code)
+            if key_code is None:
+                continue
+            pressed = op == INJECTOR_DOWN
+            if pressed:
+                self.down_keys.add(key_code)
+            else:
+                self.down_keys.discard(key_code)
+            if self.modifier_listener is not None:
+                self.modifier_listener(key_code, pressed)
+        del self.incoming[:usable]
+        return True
+
+
+def open_injector_socket(path: str, backend: str = "auto") -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except OSError:
+        sock.close()
+    # 注入进程的错误输出写入日志，启动失败时带上其中的原因
+    log_path = f"{path}.log"
+    with open(log_path, "w", encoding="utf-8") as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--injector", "--backend", backend],
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+            start_new_session=True,
+        )
+    for _ in range(40):
+        time.sleep(0.05)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except OSError:
+            sock.close()
+        # 退出码 0 表示已有其他注入进程在运行，继续等待它就绪
+        if process.poll():
+            break
+    try:
+        with open(log_path, encoding="utf-8", errors="replace") as fp:
+            detail = fp.read().strip().splitlines()
+    except OSError:
+        detail = []
+    reason = f": {detail[-1]}" if detail else ""
+    raise RuntimeError(f"could not start injector at {path}{reason}")
+
+
+def connect_injector(path: str, backend: str = "auto") -> RemoteEngine:
+    return RemoteEngine(path, backend)
+
+
+def run_injector(path: str, backend: str = "auto") -> int:
+    try:
+        server = InjectorServer(path, backend)
+    except RuntimeError as exc:
+        print(f"mutterboard: {exc}", file=sys.stderr)
+        return 0
+    loop = GLib.MainLoop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, loop.quit)
+    try:
+        loop.run()
+    finally:
+        server.close()
+    return 0
 
 
 class MutterBoard(Gtk.Window):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        engine: Optional[KeyboardEngine] = None,
+        clock=None,
+        replay_settings: Optional[Dict[str, object]] = None,
+    ) -> None:
         super().__init__(title="MutterBoard", name="toplevel")
         self._configure_window()
         self._configure_storage()
 
-        self.engine = KeyboardEngine()
+        self.clock = clock if clock is not None else MainLoopClock()
+        self.trace = EventTrace()
+        self.profiler: Optional[cProfile.Profile] = None
+        # 回放与基准测试只在内存中计数，不改动真实统计
+        self.usage = UsageStats(os.path.join(self.cache_dir, "usage.bin") if replay_settings is None else None)
+        self.engine = engine if engine is not None else KeyboardEngine()
+        self.engine.trace = self.trace
+        if isinstance(self.engine, RemoteEngine):
+            self.engine.modifier_listener = self._on_shared_modifier
+            self.engine.status_listener = self._on_injector_status
         self.modifiers: Dict[int, ModifierState] = {key: ModifierState() for key in MODIFIER_KEYS}
         self.modifier_buttons: Dict[int, Gtk.Button] = {}
         self.regular_buttons: Dict[str, Gtk.Button] = {}
@@ -221,6 +1437,17 @@ class MutterBoard(Gtk.Window):
         self.space_button: Optional[Gtk.Button] = None
         self.space_button_default_label = "Space"
         self.caps_indicator_button: Optional[Gtk.Button] = None
+        self.char_popup: Optional[Gtk.Popover] = None
+        self.keymap: Optional[Gdk.Keymap] = None
+        self.grid: Optional[Gtk.Grid] = None
+        self.layout = DEFAULT_LAYOUT
+        self.layout_digest: Optional[str] = None
+        self.layout_columns = 1
+        self.row_buttons: List[List[Gtk.Button]] = []
+        self.css_provider: Optional[Gtk.CssProvider] = None
+        self.css_providers: Dict[Tuple[str, int, int], Gtk.CssProvider] = {}
+        self.resize_tick: Optional[int] = None
+        self.auto_font_source: Optional[int] = None
 
         self.space_long_press_ms = 300
         self.space_cursor_mode = False
@@ -237,19 +1464,39 @@ class MutterBoard(Gtk.Window):
         self.double_shift_shortcut = [uinput.KEY_LEFTSHIFT, uinput.KEY_SPACE]
         self.capslock_on = False
 
+        self.paste_threshold = 256
+        self.paste_restore_ms = 300
+        self.paste_restore_timeout_ms = 10000
+        self.clipboard = SystemClipboard() if replay_settings is None else MemoryClipboard()
+        self.clipboard_saved: Optional[str] = None
+        self.clipboard_restore_source: Optional[int] = None
+
         self.theme_name = "Dark"
         self.opacity = "0.96"
         self.font_size = 18
+        self.auto_font = False
         self.width = 0
         self.height = 0
 
-        self._load_settings()
+        if replay_settings is None:
+            self.layout = load_layout(self.layout_file)
+            self.layout_digest = file_digest(self.layout_file)
+            self._load_settings()
+        else:
+            self._apply_trace_settings(replay_settings)
         self._build_ui()
+        self._watch_lock_state()
         self._update_caps_indicator()
         self.apply_css()
 
         self.connect("configure-event", self.on_resize)
-        self.connect("destroy", lambda _: self.save_settings())
+        self.connect("destroy", lambda _: self.usage.flush())
+        if replay_settings is None:
+            # 回放与基准测试窗口不监视配置、不保存设置，也不接管信号与异常钩子
+            self._watch_config()
+            self.connect("destroy", lambda _: self.save_settings())
+            GLib.timeout_add_seconds(USAGE_FLUSH_SECONDS, self._flush_usage)
+            self._install_debug_hooks()
 
     def _configure_window(self) -> None:
         self.set_border_width(0)
@@ -270,6 +1517,85 @@ class MutterBoard(Gtk.Window):
         self.config_dir = os.path.expanduser("~/.config/mutterboard")
         self.config_file = os.path.join(self.config_dir, "settings.conf")
         self.config = configparser.ConfigParser()
+        self.cache_dir = os.path.expanduser("~/.cache/mutterboard")
+        self.theme_dir = os.path.join(self.config_dir, "themes")
+        self.layout_file = os.path.join(self.config_dir, "layout.txt")
+        self.snippet_dir = os.path.join(self.config_dir, "snippets")
+        self.settings_digest: Optional[str] = None
+        self.double_shift_shortcut_raw = "LEFTSHIFT,SPACE"
+        self.config_monitors: List[Gio.FileMonitor] = []
+        self.reload_source: Optional[int] = None
+        self.theme_store = ThemeStore(self.theme_dir, os.path.join(self.cache_dir, "css"))
+
+    def _install_debug_hooks(self) -> None:
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self._on_trace_signal)
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR2, self._on_profile_signal)
+        previous_hook = sys.excepthook
+
+        def _crash_hook(exc_type, exc, tb) -> None:
+            self.dump_trace()
+            previous_hook(exc_type, exc, tb)
+
+        sys.excepthook = _crash_hook
+
+    def _on_trace_signal(self) -> bool:
+        self.dump_trace()
+        return True
+
+    def dump_trace(self) -> Optional[str]:
+        path = os.path.join(self.cache_dir, f"trace-{time.strftime('%Y%m%d-%H%M%S')}.bin")
+        try:
+            self.trace.dump(path, self._trace_settings())
+        except OSError:
+            return None
+        return path
+
+    def _trace_settings(self) -> Dict[str, object]:
+        # 影响按键发送结果的设置随追踪一起保存，回放不依赖当前的配置文件
+        return {
+            "layout": self.layout,
+            "double_shift_shortcut_enabled": self.double_shift_shortcut_enabled,
+            "double_shift_shortcut": self.double_shift_shortcut_raw,
+            "double_shift_timeout_ms": self.double_shift_timeout_ms,
+            "space_long_press_ms": self.space_long_press_ms,
+            "paste_threshold": self.paste_threshold,
+        }
+
+    def _apply_trace_settings(self, settings: Dict[str, object]) -> None:
+        self.layout = [list(row) for row in settings.get("layout", DEFAULT_LAYOUT)] or DEFAULT_LAYOUT
+        self.double_shift_shortcut_enabled = bool(
+            settings.get("double_shift_shortcut_enabled", self.double_shift_shortcut_enabled)
+        )
+        self.double_shift_shortcut_raw = str(settings.get("double_shift_shortcut", self.double_shift_shortcut_raw))
+        self.double_shift_shortcut = self._parse_shortcut(self.double_shift_shortcut_raw)
+        self.double_shift_timeout_ms = int(settings.get("double_shift_timeout_ms", self.double_shift_timeout_ms))
+        self.space_long_press_ms = int(settings.get("space_long_press_ms", self.space_long_press_ms))
+        self.paste_threshold = int(settings.get("paste_threshold", self.paste_threshold))
+
+    def _on_profile_signal(self) -> bool:
+        self.toggle_profiler()
+        return True
+
+    def toggle_profiler(self, _button=None) -> Optional[str]:
+        # 主循环回调都在同一线程，cProfile 可以覆盖样式、标签、计时器与光标模式处理
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            self.profile_btn.set_label("⏹")
+            return None
+
+        self.profiler.disable()
+        path = os.path.join(self.cache_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.pstats")
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.profiler.dump_stats(path)
+        except OSError:
+            path = None
+        self.profiler = None
+        self.profile_btn.set_label("⏱")
+        if path is not None:
+            print(f"mutterboard: profile written to {path}", file=sys.stderr)
+        return path
 
     def _build_ui(self) -> None:
         root = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=0)
@@ -290,12 +1616,13 @@ class MutterBoard(Gtk.Window):
         self.header.pack_start(self.header_controls)
 
         self._create_header_button("☰", self.toggle_controls)
+        self.profile_btn = self._create_header_button("⏱", self.toggle_profiler)
         self._create_header_button("+", self.change_opacity, True)
         self._create_header_button("-", self.change_opacity, False)
         self.opacity_btn = self._create_header_button(self.opacity)
         self._create_header_button("A+", self.change_font_size, 1)
         self._create_header_button("A-", self.change_font_size, -1)
-        self.font_btn = self._create_header_button(f"{self.font_size}px")
+        self.font_btn = self._create_header_button(self._font_label(), self.toggle_auto_font)
 
         # CapsLock 指示器按钮
         self.caps_indicator_button = Gtk.Button(label="Caps: Off")
@@ -306,57 +1633,130 @@ class MutterBoard(Gtk.Window):
         self.header_controls.pack_start(self.caps_indicator_button, False, False, 0)
 
         self.theme_combobox = Gtk.ComboBoxText()
-        self.theme_combobox.append_text("Theme")
-        for name in THEMES:
-            self.theme_combobox.append_text(name)
-        self.theme_combobox.set_active(0)
-        if self.theme_name in THEMES:
-            self.theme_combobox.set_active(list(THEMES.keys()).index(self.theme_name) + 1)
+        self._fill_theme_combobox()
         self.theme_combobox.set_name("combobox")
         self.theme_combobox.connect("changed", self.change_theme)
         self.header_controls.pack_start(self.theme_combobox, False, False, 0)
 
+    def _fill_theme_combobox(self) -> None:
+        self.theme_combobox.remove_all()
+        self.theme_combobox.append_text("Theme")
+        theme_names = self.theme_store.names()
+        for name in theme_names:
+            self.theme_combobox.append_text(name)
+        self.theme_combobox.set_active(0)
+        if self.theme_name in theme_names:
+            self.theme_combobox.set_active(theme_names.index(self.theme_name) + 1)
+
     def _build_keyboard(self, parent: Gtk.Box) -> None:
         grid = Gtk.Grid()
+        self.grid = grid
         grid.set_name("grid")
-        grid.set_row_spacing(2)
-        grid.set_column_spacing(2)
+        grid.set_row_spacing(0)
+        grid.set_column_spacing(0)
         grid.set_row_homogeneous(True)
         grid.set_column_homogeneous(True)
         parent.pack_start(grid, True, True, 0)
-
-        row_widths = [sum(KEY_WIDTHS.get(label, 2) for label in row) for row in DEFAULT_LAYOUT]
-        target_width = max(row_widths)
-
-        for row_index, row in enumerate(DEFAULT_LAYOUT):
-            widths = self._balanced_row_widths(row, target_width)
-            col = 0
-            for label, width in zip(row, widths):
-                key_code = LABEL_TO_KEY[label]
+        grid.connect("size-allocate", self._on_grid_allocate)
+
+        self.layout_columns = self._layout_width(self.layout)
+        for row_index, row in enumerate(self.layout):
+            self.row_buttons.append(self._build_row(row_index, row))
+
+    @staticmethod
+    def _layout_width(layout: List[List[str]]) -> int:
+        return max(sum(KEY_WIDTHS.get(label, 2) for label in row) for row in layout)
+
+    def _build_row(self, row_index: int, row: List[str]) -> List[Gtk.Button]:
+        buttons: List[Gtk.Button] = []
+        col = 0
+        for label, width in zip(row, self._balanced_row_widths(row, self.layout_columns)):
+            key_code = LABEL_TO_KEY.get(label)
+            snippet = label[1:] if key_code is None and len(label) > 1 and label.startswith("@") else None
+            if snippet is not None:
+                shown = snippet
+            else:
                 shown = label[:-2] if label.endswith("_L") or label.endswith("_R") else label
-                button = Gtk.Button(label=shown)
-                button.set_name("key")
-                button.get_style_context().add_class("key-button")
-                button.set_can_focus(False)
-                button.set_focus_on_click(False)
-                button.connect("pressed", self.on_button_press, key_code)
-                button.connect("released", self.on_button_release, key_code)
-
-                if key_code == uinput.KEY_SPACE:
-                    self.space_button = button
-                    self.space_button_default_label = shown
-                    button.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
-                    button.connect("motion-notify-event", self.on_space_motion)
-
-                grid.attach(button, col, row_index, width, 1)
-                col += width
-
-                if key_code in MODIFIER_KEYS:
-                    self.modifier_buttons[key_code] = button
+            button = Gtk.Button(label=shown)
+            button.set_name("key")
+            button.get_style_context().add_class("key-button")
+            button.set_can_focus(False)
+            button.set_focus_on_click(False)
+            self.grid.attach(button, col, row_index, width, 1)
+            col += width
+            buttons.append(button)
+
+            if snippet is not None:
+                # @名称 对应 snippets/名称.txt，按下时才读取，可随时编辑
+                button.connect("pressed", self.on_snippet_key_press, snippet)
+                continue
+            if key_code is None:
+                # 布局中的非 US 字符或文本片段直接按 Unicode 发送
+                button.connect("pressed", self.on_text_key_press, label)
+                continue
+
+            button.connect("pressed", self.on_button_press, key_code)
+            button.connect("released", self.on_button_release, key_code)
+
+            if key_code == uinput.KEY_SPACE:
+                self.space_button = button
+                self.space_button_default_label = shown
+                button.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
+                button.connect("motion-notify-event", self.on_space_motion)
+
+            if key_code in MODIFIER_KEYS:
+                self.modifier_buttons[key_code] = button
+            else:
+                self.regular_buttons[label] = button
+        return buttons
+
+    def _remove_row(self, buttons: List[Gtk.Button]) -> None:
+        # 被销毁的按钮收不到 released 信号：先停止连发并松开属于它的键，避免卡键
+        for button in buttons:
+            for key_code in [key for key, registered in self.modifier_buttons.items() if registered is button]:
+                self.active_keys.discard(key_code)
+                state = self.modifiers[key_code]
+                if state.pressed or state.latched:
+                    self._force_release_modifier(key_code)
+                del self.modifier_buttons[key_code]
+            for label in [label for label, registered in self.regular_buttons.items() if registered is button]:
+                key_code = LABEL_TO_KEY[label]
+                self._cancel_repeat(key_code)
+                self.active_keys.discard(key_code)
+                del self.regular_buttons[label]
+            if button is self.space_button:
+                self.active_keys.discard(uinput.KEY_SPACE)
+                self._cancel_space_long_press()
+                self.space_cursor_mode = False
+                self.space_button = None
+            if self.char_popup is not None and self.char_popup.get_relative_to() is button:
+                self._close_char_popup()
+            button.destroy()
+
+    def _apply_layout(self, layout: List[List[str]]) -> None:
+        # 总宽度与行数不变时只重建内容变化的行
+        columns = self._layout_width(layout)
+        rebuild_all = columns != self.layout_columns or len(layout) != len(self.layout)
+        self.layout_columns = columns
+        for row_index in range(max(len(layout), len(self.layout))):
+            if not rebuild_all and layout[row_index] == self.layout[row_index]:
+                continue
+            if row_index < len(self.row_buttons):
+                self._remove_row(self.row_buttons[row_index])
+            if row_index < len(layout):
+                buttons = self._build_row(row_index, layout[row_index])
+                for button in buttons:
+                    button.show()
+                if row_index < len(self.row_buttons):
+                    self.row_buttons[row_index] = buttons
                 else:
-                    self.regular_buttons[label] = button
+                    self.row_buttons.append(buttons)
+        del self.row_buttons[len(layout) :]
+        self.layout = layout
+        self._update_shift_labels()
 
-    def _balanced_row_widths(self, row: List[str], target_width: int) -> List[int]:
+    @staticmethod
+    def _balanced_row_widths(row: List[str], target_width: int) -> List[int]:
         widths = [KEY_WIDTHS.get(label, 2) for label in row]
         deficit = target_width - sum(widths)
         idx = 0
@@ -378,117 +1778,34 @@ class MutterBoard(Gtk.Window):
         self.settings_buttons.append(button)
         return button
 
-    def _theme(self) -> Dict[str, str]:
-        return THEMES.get(self.theme_name, THEMES["Dark"])
+    def _key_font_size(self) -> int:
+        if not self.auto_font or self.grid is None:
+            return self.font_size
+        grid_width = self.grid.get_allocated_width()
+        grid_height = self.grid.get_allocated_height()
+        if grid_width <= 1 or grid_height <= 1:
+            return self.font_size
+        rows = len(self.layout)
+        cell_height = grid_height / rows
+        cell_width = 2 * grid_width / self.layout_columns
+        # 按 2px 分档，避免拖动过程中每个像素都生成新样式
+        size = int(min(cell_height * 0.4, cell_width * 0.5)) // 2 * 2
+        return min(48, max(10, size))
 
     def apply_css(self) -> None:
-        theme = self._theme()
         self.set_opacity(float(self.opacity))
-        provider = Gtk.CssProvider()
-        css = f"""
-        #toplevel {{ background-color: rgb({theme['bg']}); }}
-        #root {{ background-color: rgb({theme['bg']}); margin: 0; padding: 0; }}
-        headerbar {{
-            background-color: rgb({theme['bg']});
-            border: 0;
-            box-shadow: none;
-            min-height: 54px;
-        }}
-        headerbar button {{
-            background-image: none;
-            background-color: rgb({theme['key']});
-            border: 1px solid rgb({theme['key_border']});
-            min-height: 46px;
-            min-width: 52px;
-            border-radius: 8px;
-            margin: 4px 0;  /* 垂直居中，避免贴顶 */
-        }}
-        /* 不可用按钮（如 Caps 指示器）样式与普通按钮一致 */
-        headerbar button:disabled {{
-            background-image: none;
-            background-color: rgb({theme['key']});
-            border: 1px solid rgb({theme['key_border']});
-        }}
-        headerbar .titlebutton {{
-            min-width: 56px;
-            min-height: 46px;
-            background-color: rgb({theme['key']});
-        }}
-        #combobox button.combo {{
-            background-image: none;
-            background-color: rgb({theme['key']});
-            border: 1px solid rgb({theme['key_border']});
-            min-height: 46px;
-            min-width: 90px;
-            border-radius: 8px;
-        }}
-        headerbar button label, #combobox button.combo label {{
-            color: {theme['text']};
-            font-size: {max(self.font_size - 1, 12)}px;
-            font-weight: 600;
-        }}
-        #grid {{ margin: 0; padding: 0; }}
-        .key-button,
-        button.key-button,
-        .key-button:hover,
-        button.key-button:hover,
-        .key-button:focus,
-        button.key-button:focus,
-        .key-button:checked,
-        button.key-button:checked,
-        .key-button:active,
-        button.key-button:active,
-        .key-button:backdrop {{
-            border-radius: 8px;
-            border: 1px solid rgb({theme['key_border']});
-            background-image: none;
-            background-color: rgb({theme['key']});
-            box-shadow: none;
-            outline: none;
-            min-height: 48px;
-            margin: 0;
-            padding: 0;
-        }}
-        .key-button label {{ color: {theme['text']}; font-weight: 600; font-size: {self.font_size}px; }}
-        /* CapsLock 指示器按钮样式，与 header 其他按钮一致 */
-        #caps-indicator {{
-            background-image: none;
-            background-color: rgb({theme['key']});
-            border: 1px solid rgb({theme['key_border']});
-            border-radius: 8px;
-            min-height: 46px;
-            min-width: 85px;          /* 宽度适配文本 */
-            margin: 4px 0;             /* 与普通按钮一致 */
-            padding: 0 8px;
-            color: {theme['text']};
-            font-size: {max(self.font_size - 2, 11)}px;
-            font-weight: 700;
-        }}
-        /* CapsLock 开启时的蓝色文字 */
-        #caps-indicator.caps-on {{
-            color: rgba({theme['accent']}, 1.0);
-        }}
-        #caps-indicator.caps-on label {{
-            color: rgba({theme['accent']}, 1.0);
-        }}
-        .key-button.pressed,
-        .key-button.pressed:hover,
-        .key-button.pressed:focus,
-        .key-button.pressed:active {{
-            background-color: rgba({theme['accent']}, 0.28);
-            border-color: rgba({theme['accent']}, 1.0);
-        }}
-        .key-button.cursor-mode {{
-            background-color: rgba({theme['accent']}, 0.24);
-            border-color: rgba({theme['accent']}, 1.0);
-        }}
-        .key-button.cursor-mode label {{
-            color: rgba({theme['accent']}, 1.0);
-            font-weight: 700;
-        }}
-        """
-        provider.load_from_data(css.encode("utf-8"))
-        Gtk.StyleContext.add_provider_for_screen(self.get_screen(), provider, Gtk.STYLE_PROVIDER_PRIORITY_USER)
+        key = (self.theme_name, self.font_size, self._key_font_size())
+        provider = self.css_providers.get(key)
+        if provider is None:
+            provider = self.theme_store.load_provider(*key)
+            self.css_providers[key] = provider
+        if provider is self.css_provider:
+            return
+        screen = self.get_screen()
+        if self.css_provider is not None:
+            Gtk.StyleContext.remove_provider_for_screen(screen, self.css_provider)
+        Gtk.StyleContext.add_provider_for_screen(screen, provider, Gtk.STYLE_PROVIDER_PRIORITY_USER)
+        self.css_provider = provider
 
     def toggle_controls(self, _button=None) -> None:
         for button in self.settings_buttons[1:]:
@@ -501,14 +1818,23 @@ class MutterBoard(Gtk.Window):
         self.opacity_btn.set_label(self.opacity)
         self.apply_css()
 
+    def _font_label(self) -> str:
+        return "Auto" if self.auto_font else f"{self.font_size}px"
+
     def change_font_size(self, _button, delta: int) -> None:
         self.font_size = min(48, max(10, self.font_size + delta * 2))
-        self.font_btn.set_label(f"{self.font_size}px")
+        self.auto_font = False
+        self.font_btn.set_label(self._font_label())
+        self.apply_css()
+
+    def toggle_auto_font(self, _button=None) -> None:
+        self.auto_font = not self.auto_font
+        self.font_btn.set_label(self._font_label())
         self.apply_css()
 
     def change_theme(self, _widget) -> None:
         selected = self.theme_combobox.get_active_text()
-        if selected in THEMES:
+        if selected in self.theme_store.sources:
             self.theme_name = selected
             self.apply_css()
 
@@ -522,6 +1848,20 @@ class MutterBoard(Gtk.Window):
         else:
             style.remove_class("caps-on")
 
+    def _watch_lock_state(self) -> None:
+        # 通过 XKB 状态通知同步真实 CapsLock 状态，无需轮询
+        self.keymap = Gdk.Keymap.get_for_display(self.get_display())
+        if self.keymap is None:
+            return
+        self.capslock_on = self.keymap.get_caps_lock_state()
+        self.keymap.connect("state-changed", self._on_keymap_state_changed)
+
+    def _on_keymap_state_changed(self, keymap: Gdk.Keymap) -> None:
+        capslock_on = keymap.get_caps_lock_state()
+        if capslock_on != self.capslock_on:
+            self.capslock_on = capslock_on
+            self._update_caps_indicator()
+
     def _draw_caps_indicator(self, area: Gtk.DrawingArea, cr) -> bool:
         alloc = area.get_allocation()
         radius = min(alloc.width, alloc.height) / 2
@@ -531,12 +1871,17 @@ class MutterBoard(Gtk.Window):
         return False
 
     def on_button_press(self, widget: Gtk.Button, key_code: int) -> None:
+        self.trace.record(TRACE_PRESS, key_code[1])
+        self.usage.record_press(key_code[1], self._usage_modifier_mask())
         self.active_keys.add(key_code)
+        self._close_char_popup()
 
         if key_code == uinput.KEY_CAPSLOCK:
             self._flash_regular_key(widget)
-            self.capslock_on = not self.capslock_on
             self.engine.tap_key(uinput.KEY_CAPSLOCK)
+            # 先在本地切换；XKB 状态通知到达时再以真实状态为准。
+            # 目标为原生 Wayland 应用时 XWayland 不会收到锁定状态变化，只能依赖本地切换
+            self.capslock_on = not self.capslock_on
             self._update_caps_indicator()
             return
 
@@ -560,6 +1905,7 @@ class MutterBoard(Gtk.Window):
         self._start_repeat(key_code)
 
     def on_button_release(self, widget: Gtk.Button, key_code: int) -> None:
+        self.trace.record(TRACE_RELEASE, key_code[1])
         self.active_keys.discard(key_code)
         if key_code in MODIFIER_KEYS or key_code == uinput.KEY_SPACE:
             self._paint_pressed(widget, False)
@@ -628,7 +1974,7 @@ class MutterBoard(Gtk.Window):
             self.last_shift_tap_at = 0.0
             return
 
-        now = time.monotonic()
+        now = self.clock.now()
         elapsed_ms = (now - self.last_shift_tap_at) * 1000
         if self.last_shift_tap_at > 0 and elapsed_ms <= self.double_shift_timeout_ms:
             for shift_key in SHIFT_KEYS:
@@ -653,6 +1999,36 @@ class MutterBoard(Gtk.Window):
         for key in reversed(mods):
             self.engine.set_key_state(key, False)
 
+    def _on_shared_modifier(self, key_code: int, pressed: bool) -> None:
+        # 其他窗口改变了修饰键：只同步本地状态与绘制，不再回发
+        state = self.modifiers[key_code]
+        if pressed:
+            if not (state.pressed or state.latched):
+                state.latched = True
+                self._paint_modifier(key_code, True)
+        else:
+            state.latched = False
+            if state.pressed:
+                state.used_in_combo = True
+            else:
+                self._paint_modifier(key_code, False)
+        self._update_shift_labels()
+
+    def _on_injector_status(self, error: Optional[str]) -> None:
+        # 注入进程不可用时按键无法发送，在标题栏显示原因，恢复后清除
+        self.header.set_subtitle(error)
+
+    def _usage_modifier_mask(self) -> int:
+        mask = 0
+        for key_code, state in self.modifiers.items():
+            if state.pressed or state.latched:
+                mask |= USAGE_MODIFIER_BITS[key_code]
+        return mask
+
+    def _flush_usage(self) -> bool:
+        self.usage.flush()
+        return True
+
     def _force_release_modifier(self, key_code: int) -> None:
         state = self.modifiers[key_code]
         state.pressed = False
@@ -680,10 +2056,138 @@ class MutterBoard(Gtk.Window):
             self._paint_pressed(button, False)
             return False
 
-        GLib.timeout_add(110, _clear)
+        self.clock.timeout_add(110, _clear)
+
+    def on_text_key_press(self, widget: Gtk.Button, text: str) -> None:
+        self._close_char_popup()
+        self._flash_regular_key(widget)
+        self.emit_text(text)
+
+    def on_snippet_key_press(self, widget: Gtk.Button, name: str) -> None:
+        self._close_char_popup()
+        self._flash_regular_key(widget)
+        path = os.path.join(self.snippet_dir, f"{name}.txt")
+        try:
+            with open(path, encoding="utf-8") as fp:
+                text = fp.read()
+        except (OSError, UnicodeDecodeError) as exc:
+            print(f"mutterboard: cannot read snippet {path}: {exc}", file=sys.stderr)
+            return
+        # 编辑器通常会在文件末尾补一个换行，不把它当作内容
+        self.emit_text(text[:-1] if text.endswith("\n") else text)
+
+    def emit_text(self, text: str) -> None:
+        # 整段文本记为一条，回放时同样经由 emit_text。
+        # 锁定的一次性修饰键先释放再输入，否则片段中的每个字母都会变成快捷键
+        self.trace.record_text(text)
+        self._release_one_shot_modifiers()
+        self._update_shift_labels()
+        if self.paste_threshold > 0 and len(text) >= self.paste_threshold:
+            self._paste_text(text)
+        else:
+            for char in text:
+                self.engine.emit_char(char)
+
+    def _paste_text(self, text: str) -> None:
+        # 大段文本走剪贴板：一次 Ctrl+V 代替逐字按键，稍后恢复原剪贴板内容。
+        # 原内容异步读取，不用 wait_for_text()：它会运行嵌套主循环，可能阻塞并在粘贴中途处理其他按键
+        if self.clipboard_restore_source is not None:
+            # 上一次粘贴尚未恢复，保存的仍是用户原来的内容
+            self.clock.source_remove(self.clipboard_restore_source)
+            self.clipboard_restore_source = None
+            self._send_paste(text)
+        else:
+            self.clipboard.request_text(self._on_clipboard_saved, text)
+
+    def _on_clipboard_saved(self, _clipboard, saved: Optional[str], text: str) -> None:
+        if self.clipboard_restore_source is not None:
+            # 读取期间另一次粘贴已完成，读到的是它的文本
+            self.clock.source_remove(self.clipboard_restore_source)
+            self.clipboard_restore_source = None
+        else:
+            self.clipboard_saved = saved
+        self._send_paste(text)
+
+    def _send_paste(self, text: str) -> None:
+        # 目标程序取走文本后才恢复；一直没有取走时以较长的超时兜底
+        self._schedule_clipboard_restore(self.paste_restore_timeout_ms)
+        self.clipboard.offer(text, self._on_paste_fetched, self._on_paste_lost)
+        self._emit_shortcut([uinput.KEY_LEFTCTRL, uinput.KEY_V])
+
+    def _on_paste_fetched(self) -> None:
+        # 目标程序可能依次请求多种格式，稍等片刻再恢复
+        self._schedule_clipboard_restore(self.paste_restore_ms)
+
+    def _on_paste_lost(self) -> None:
+        # 剪贴板已被其他程序接管，不再用旧内容覆盖
+        self.clipboard_saved = None
+        self._schedule_clipboard_restore(0)
+
+    def _schedule_clipboard_restore(self, delay_ms: int) -> None:
+        if self.clipboard_restore_source is not None:
+            self.clock.source_remove(self.clipboard_restore_source)
+            self.clipboard_restore_source = None
+        if self.clipboard_saved is not None:
+            self.clipboard_restore_source = self.clock.timeout_add(delay_ms, self._restore_clipboard)
+
+    def _restore_clipboard(self) -> bool:
+        self.clipboard_restore_source = None
+        if self.clipboard_saved is not None:
+            self.clipboard.set_text(self.clipboard_saved, -1)
+            self.clipboard_saved = None
+        return False
+
+    def emit_character(self, char: str, replace: bool = False) -> None:
+        self.trace.record(TRACE_CHAR_REPLACE if replace else TRACE_CHAR, ord(char))
+        if replace:
+            self.engine.tap_key(uinput.KEY_BACKSPACE)
+        self.engine.emit_char(char)
+        self._release_one_shot_modifiers()
+        self._update_shift_labels()
+
+    def _show_char_popup(self, key_code: int) -> None:
+        label = KEY_MAPPING[key_code]
+        anchor = self.regular_buttons.get(label)
+        if anchor is None:
+            return
+        self._close_char_popup()
+        shift_active = self._shift_active()
+        box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=2)
+        popover = Gtk.Popover.new(anchor)
+        popover.set_modal(False)
+        for char in LONG_PRESS_CHARS[label]:
+            shown = char.upper() if shift_active and len(char.upper()) == 1 else char
+            button = Gtk.Button(label=shown)
+            button.set_name("key")
+            button.get_style_context().add_class("key-button")
+            button.set_can_focus(False)
+            button.set_focus_on_click(False)
+            button.connect("clicked", self._on_char_popup_choice, shown)
+            box.pack_start(button, False, False, 0)
+        popover.add(box)
+        box.show_all()
+        popover.popup()
+        self.char_popup = popover
+
+    def _on_char_popup_choice(self, _button: Gtk.Button, char: str) -> None:
+        self._close_char_popup()
+        # 按下时已先发送了基础字符，这里替换掉它
+        self.emit_character(char, replace=True)
+
+    def _close_char_popup(self) -> None:
+        if self.char_popup is not None:
+            self.char_popup.popdown()
+            self.char_popup.destroy()
+            self.char_popup = None
+
+    def _shift_active(self) -> bool:
+        return any(self.modifiers[k].pressed or self.modifiers[k].latched for k in SHIFT_KEYS)
+
+    def _command_modifier_active(self) -> bool:
+        return any(state.pressed or state.latched for key, state in self.modifiers.items() if key not in SHIFT_KEYS)
 
     def _update_shift_labels(self) -> None:
-        shift_active = any(self.modifiers[k].pressed or self.modifiers[k].latched for k in SHIFT_KEYS)
+        shift_active = self._shift_active()
         for plain, symbol in SYMBOL_LABELS.items():
             button = self.regular_buttons.get(plain)
             if button is not None:
@@ -694,22 +2198,31 @@ class MutterBoard(Gtk.Window):
             return
         self._cancel_repeat(key_code)
         state = RepeatState()
-        state.delay_source = GLib.timeout_add(420, self._repeat_delay_done, key_code)
+        # 按下时带有 Ctrl/Alt/Super 的是快捷键，长按照常连发而不弹出候选
+        state.show_popup = KEY_MAPPING[key_code] in LONG_PRESS_CHARS and not self._command_modifier_active()
+        state.delay_source = self.clock.timeout_add(420, self._repeat_delay_done, key_code)
         self.repeat_states[key_code] = state
 
     def _repeat_delay_done(self, key_code: int) -> bool:
+        self.trace.record(TRACE_REPEAT_DELAY, key_code[1])
         state = self.repeat_states.get(key_code)
         if state is None or key_code not in self.active_keys:
             return False
-        state.repeat_source = GLib.timeout_add(70, self._repeat_tick, key_code)
+        if state.show_popup:
+            state.delay_source = None
+            self._show_char_popup(key_code)
+            return False
+        state.repeat_source = self.clock.timeout_add(70, self._repeat_tick, key_code)
         state.delay_source = None
         return False
 
     def _repeat_tick(self, key_code: int) -> bool:
+        self.trace.record(TRACE_REPEAT_TICK, key_code[1])
         if key_code not in self.active_keys:
             self._cancel_repeat(key_code)
             return False
         self.engine.tap_key(key_code)
+        self.usage.repeats[key_code[1]] += 1
         return True
 
     def _cancel_repeat(self, key_code: int) -> None:
@@ -717,9 +2230,9 @@ class MutterBoard(Gtk.Window):
         if state is None:
             return
         if state.delay_source:
-            GLib.source_remove(state.delay_source)
+            self.clock.source_remove(state.delay_source)
         if state.repeat_source:
-            GLib.source_remove(state.repeat_source)
+            self.clock.source_remove(state.repeat_source)
 
     def _begin_space_tracking(self) -> None:
         self._cancel_space_long_press()
@@ -728,7 +2241,9 @@ class MutterBoard(Gtk.Window):
         self.space_accum_x = 0.0
         self.space_accum_y = 0.0
         self.space_last_motion_at = 0.0
-        self.space_long_press_source = GLib.timeout_add(self.space_long_press_ms, self._enter_space_cursor_mode)
+        self.space_long_press_source = self.clock.timeout_add(
+            self.space_long_press_ms, self._enter_space_cursor_mode
+        )
 
     def _finish_space_tracking(self) -> None:
         moved = self.space_cursor_mode
@@ -743,10 +2258,11 @@ class MutterBoard(Gtk.Window):
 
     def _cancel_space_long_press(self) -> None:
         if self.space_long_press_source is not None:
-            GLib.source_remove(self.space_long_press_source)
+            self.clock.source_remove(self.space_long_press_source)
             self.space_long_press_source = None
 
     def _enter_space_cursor_mode(self) -> bool:
+        self.trace.record(TRACE_CURSOR_MODE)
         if uinput.KEY_SPACE not in self.active_keys:
             return False
         self.space_cursor_mode = True
@@ -767,6 +2283,8 @@ class MutterBoard(Gtk.Window):
     def on_space_motion(self, _widget: Gtk.Button, event: Gdk.EventMotion) -> bool:
         if uinput.KEY_SPACE not in self.active_keys:
             return False
+        # 光标步长由事件自带的时间计算，键码字段改存 event.time 供回放使用
+        self.trace.record(TRACE_MOTION, event.time & 0xFFFFFFFF, event.x, event.y)
 
         if self.space_last_motion_at == 0.0:
             self.space_last_x = event.x
@@ -798,6 +2316,7 @@ class MutterBoard(Gtk.Window):
                 key = uinput.KEY_RIGHT if self.space_accum_x > 0 else uinput.KEY_LEFT
                 for _ in range(steps):
                     self.engine.tap_key(key)
+                self.usage.cursor_steps[key[1]] += steps
                 self.space_accum_x -= step_threshold * steps if self.space_accum_x > 0 else -step_threshold * steps
                 self.space_accum_y = 0.0
         else:
@@ -806,6 +2325,7 @@ class MutterBoard(Gtk.Window):
                 key = uinput.KEY_DOWN if self.space_accum_y > 0 else uinput.KEY_UP
                 for _ in range(steps):
                     self.engine.tap_key(key)
+                self.usage.cursor_steps[key[1]] += steps
                 self.space_accum_y -= step_threshold * steps if self.space_accum_y > 0 else -step_threshold * steps
                 self.space_accum_x = 0.0
 
@@ -854,49 +2374,375 @@ class MutterBoard(Gtk.Window):
         if not os.path.exists(self.config_file):
             return
 
+        self.settings_digest = file_digest(self.config_file)
         try:
             self.config.read(self.config_file)
-            self.theme_name = self.config.get("DEFAULT", "theme", fallback=self.theme_name)
-            self.opacity = self.config.get("DEFAULT", "opacity", fallback=self.opacity)
-            self.font_size = self.config.getint("DEFAULT", "font_size", fallback=self.font_size)
+            self._read_preferences(self.config)
             self.width = self.config.getint("DEFAULT", "width", fallback=0)
             self.height = self.config.getint("DEFAULT", "height", fallback=0)
-            self.double_shift_shortcut_enabled = self.config.getboolean(
-                "DEFAULT", "double_shift_shortcut_enabled", fallback=self.double_shift_shortcut_enabled
-            )
-            shortcut = self.config.get("DEFAULT", "double_shift_shortcut", fallback="LEFTSHIFT,SPACE")
-            self.double_shift_shortcut = self._parse_shortcut(shortcut)
             self.capslock_on = self.config.getboolean("DEFAULT", "capslock_on", fallback=self.capslock_on)
-        except configparser.Error:
+        except (configparser.Error, ValueError):
             return
 
-        self.font_size = min(48, max(10, self.font_size))
         if self.width > 0 and self.height > 0:
             self.set_default_size(self.width, self.height)
 
+    def _read_preferences(self, config: configparser.ConfigParser) -> None:
+        # 先全部解析，任一项无效时抛出 ValueError，当前设置保持不变
+        theme_name = config.get("DEFAULT", "theme", fallback=self.theme_name)
+        opacity = config.get("DEFAULT", "opacity", fallback=self.opacity)
+        float(opacity)
+        font_size = min(48, max(10, config.getint("DEFAULT", "font_size", fallback=self.font_size)))
+        auto_font = config.getboolean("DEFAULT", "auto_font", fallback=self.auto_font)
+        shortcut_enabled = config.getboolean(
+            "DEFAULT", "double_shift_shortcut_enabled", fallback=self.double_shift_shortcut_enabled
+        )
+        shortcut_raw = config.get("DEFAULT", "double_shift_shortcut", fallback="LEFTSHIFT,SPACE")
+        shortcut = self.double_shift_shortcut
+        if shortcut_raw != self.double_shift_shortcut_raw:
+            shortcut = self._parse_shortcut(shortcut_raw)
+        paste_threshold = config.getint("DEFAULT", "paste_threshold", fallback=self.paste_threshold)
+
+        self.theme_name = theme_name
+        self.opacity = opacity
+        self.font_size = font_size
+        self.auto_font = auto_font
+        self.double_shift_shortcut_enabled = shortcut_enabled
+        self.double_shift_shortcut = shortcut
+        self.double_shift_shortcut_raw = shortcut_raw
+        self.paste_threshold = paste_threshold
+
+    def _watch_config(self) -> None:
+        for path in (self.config_dir, self.theme_dir):
+            try:
+                monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            except GLib.Error:
+                continue
+            monitor.connect("changed", self._on_config_changed)
+            self.config_monitors.append(monitor)
+
+    def _on_config_changed(self, *_args) -> None:
+        # 一次保存通常产生多个事件，合并后再比对内容摘要
+        if self.reload_source is None:
+            self.reload_source = GLib.timeout_add(200, self._reload_config)
+
+    def _reload_config(self) -> bool:
+        self.reload_source = None
+        self._reload_settings()
+        self._reload_layout()
+        self._reload_themes()
+        return False
+
+    def _reload_settings(self) -> None:
+        digest = file_digest(self.config_file)
+        if digest is None or digest == self.settings_digest:
+            return
+        self.settings_digest = digest
+        appearance = (self.theme_name, self.opacity, self.font_size, self.auto_font)
+        config = configparser.ConfigParser()
+        try:
+            config.read(self.config_file)
+            self._read_preferences(config)
+        except (configparser.Error, ValueError):
+            return
+        if (self.theme_name, self.opacity, self.font_size, self.auto_font) != appearance:
+            self.opacity_btn.set_label(self.opacity)
+            self.font_btn.set_label(self._font_label())
+            self._fill_theme_combobox()
+            self.apply_css()
+
+    def _reload_layout(self) -> None:
+        digest = file_digest(self.layout_file)
+        if digest == self.layout_digest:
+            return
+        self.layout_digest = digest
+        self._apply_layout(load_layout(self.layout_file))
+
+    def _reload_themes(self) -> None:
+        previous = self.theme_store.sources
+        self.theme_store.refresh()
+        current = self.theme_store.sources
+        changed = {name for name in set(previous) | set(current) if previous.get(name) != current.get(name)}
+        if not changed:
+            return
+        for key in [key for key in self.css_providers if key[0] in changed]:
+            del self.css_providers[key]
+        if list(previous) != list(current):
+            self._fill_theme_combobox()
+        if self.theme_name in changed:
+            self.apply_css()
+
     def on_resize(self, *_args) -> None:
+        # 只把记录窗口尺寸合并为每帧一次；GTK 本身已按帧合并尺寸分配，这里并不减少重新布局
+        if self.resize_tick is None:
+            self.resize_tick = self.add_tick_callback(self._on_resize_tick)
+
+    def _on_resize_tick(self, *_args) -> bool:
+        self.resize_tick = None
         self.width, self.height = self.get_size()
+        return GLib.SOURCE_REMOVE
+
+    def _on_grid_allocate(self, *_args) -> None:
+        # 布局完成后才知道真实的按键尺寸，样式切换延后到空闲时执行
+        if self.auto_font and self.auto_font_source is None:
+            self.auto_font_source = GLib.idle_add(self._apply_auto_font)
+
+    def _apply_auto_font(self) -> bool:
+        self.auto_font_source = None
+        self.apply_css()
+        return False
 
     def save_settings(self) -> None:
         self.config["DEFAULT"] = {
             "theme": self.theme_name,
             "opacity": self.opacity,
             "font_size": str(self.font_size),
+            "auto_font": str(self.auto_font).lower(),
             "width": str(self.width),
             "height": str(self.height),
             "double_shift_shortcut_enabled": str(self.double_shift_shortcut_enabled).lower(),
             "double_shift_shortcut": self._shortcut_to_config(self.double_shift_shortcut),
             "capslock_on": str(self.capslock_on),
+            "paste_threshold": str(self.paste_threshold),
         }
+        buffer = io.StringIO()
+        self.config.write(buffer)
+        data = buffer.getvalue().encode("utf-8")
+        # 记录自身写入的摘要，避免触发热重载
+        self.settings_digest = hashlib.sha1(data).hexdigest()
         try:
-            with open(self.config_file, "w", encoding="utf-8") as fp:
-                self.config.write(fp)
+            with open(self.config_file, "wb") as fp:
+                fp.write(data)
         except OSError:
             pass
 
 
+def benchmark_themes(count: int) -> int:
+    with tempfile.TemporaryDirectory() as root:
+        theme_dir = os.path.join(root, "themes")
+        cache_dir = os.path.join(root, "css")
+        os.makedirs(theme_dir)
+        for index in range(count):
+            shade = 20 + index * 7 % 200
+            with open(os.path.join(theme_dir, f"bench-{index:02d}.conf"), "w", encoding="utf-8") as fp:
+                fp.write(
+                    "[theme]\n"
+                    f"bg = {shade},{shade},{shade + 10}\n"
+                    f"key = {shade + 20},{shade + 20},{shade + 30}\n"
+                    f"key_border = {shade + 40},{shade + 40},{shade + 50}\n"
+                    "accent = 102,163,255\n"
+                    "text = #F4F6FF\n"
+                    f"radius = {index % 12}\n"
+                    f"spacing = {index % 5}\n"
+                )
+
+        for label in ("cold", "warm"):
+            started = time.perf_counter()
+            store = ThemeStore(theme_dir, cache_dir)
+            discovered = time.perf_counter()
+            store.load_provider(store.names()[-1], 18, 18)
+            first = time.perf_counter()
+            for name in store.names():
+                store.load_provider(name, 18, 18)
+            finished = time.perf_counter()
+            print(
+                f"{label}: {len(store.names())} themes, discover {(discovered - started) * 1000:.2f} ms, "
+                f"startup theme {(first - discovered) * 1000:.2f} ms, "
+                f"all themes {(finished - first) * 1000 / len(store.names()):.2f} ms/theme"
+            )
+    return 0
+
+
+def benchmark_text(length: int) -> int:
+    # 只统计本进程内的开销：按键发往录制设备，目标程序处理按键与粘贴的时间不计入
+    text = ("The quick brown fox jumps over the lazy dog. " * (length // 45 + 1))[:length]
+    device = RecordingDevice()
+    win = MutterBoard(engine=KeyboardEngine(device=device), replay_settings={})
+
+    win.paste_threshold = 0
+    started = time.perf_counter()
+    win.emit_text(text)
+    finished = time.perf_counter()
+    print(
+        f"keystrokes: {length} chars, {len(device.events)} events, {(finished - started) * 1000:.2f} ms "
+        f"({(finished - started) * 1_000_000 / length:.2f} us/char)"
+    )
+
+    # 粘贴路径使用真实剪贴板：先读取原内容（与剪贴板所有者往返一次），再发送 Ctrl+V；
+    # 随后模拟目标程序取走文本，原内容在取走之后才恢复
+    device.events.clear()
+    win.clipboard = SystemClipboard()
+    win.paste_threshold = 1
+    started = time.perf_counter()
+    win.emit_text(text)
+    requested = time.perf_counter()
+    while not device.events:
+        Gtk.main_iteration()
+    pasted = time.perf_counter()
+    fetched_text = win.clipboard.clipboard.wait_for_text()
+    fetched = time.perf_counter()
+    print(
+        f"paste: {length} chars, {len(device.events)} events, request {(requested - started) * 1000:.2f} ms, "
+        f"clipboard read + Ctrl+V {(pasted - started) * 1000:.2f} ms, "
+        f"target fetch {(fetched - pasted) * 1000:.2f} ms{'' if fetched_text == text else ' (text mismatch)'}"
+    )
+    while win.clipboard_restore_source is not None:
+        Gtk.main_iteration()
+    win.destroy()
+    return 0
+
+
+def export_usage_heatmap(stats_path: str, out_path: str) -> int:
+    if not os.path.exists(stats_path):
+        print(f"{stats_path}: no usage statistics recorded yet")
+        return 1
+    try:
+        usage = UsageStats(stats_path, readonly=True)
+    except (OSError, ValueError) as exc:
+        print(f"{stats_path}: {exc}")
+        return 1
+    unit = 28
+    row_height = 64
+    layout = load_layout(os.path.expanduser("~/.config/mutterboard/layout.txt"))
+    target_width = MutterBoard._layout_width(layout)
+    rows = [MutterBoard._balanced_row_widths(row, target_width) for row in layout]
+    peak = max(max(usage.presses), 1)
+    width = target_width * unit
+    shapes: List[str] = []
+    for row_index, (row, widths) in enumerate(zip(layout, rows)):
+        x = 0
+        for label, key_width in zip(row, widths):
+            key_code = LABEL_TO_KEY.get(label)
+            count = usage.presses[key_code[1]] if key_code is not None else 0
+            heat = count / peak
+            fill = f"rgb(255,{int(255 - 200 * heat)},{int(255 - 230 * heat)})"
+            shapes.append(
+                f'<rect x="{x + 1}" y="{row_index * row_height + 1}" width="{key_width * unit - 2}" '
+                f'height="{row_height - 2}" rx="6" fill="{fill}" stroke="#707384"/>'
+                f'<text x="{x + key_width * unit / 2}" y="{row_index * row_height + 28}" text-anchor="middle" '
+                f'font-size="14" font-weight="600">{html.escape(label)}</text>'
+                f'<text x="{x + key_width * unit / 2}" y="{row_index * row_height + 48}" text-anchor="middle" '
+                f'font-size="11" fill="#444">{count}</text>'
+            )
+            x += key_width * unit
+
+    height = len(layout) * row_height
+    svg = (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="sans-serif">{"".join(shapes)}</svg>\n'
+    )
+    with open(out_path, "w", encoding="utf-8") as fp:
+        fp.write(svg)
+
+    print(f"heatmap written to {out_path}")
+    for title, counters in (("repeats", usage.repeats), ("cursor steps", usage.cursor_steps)):
+        ranked = sorted((count, code) for code, count in enumerate(counters) if count)[::-1][:10]
+        if ranked:
+            print(f"{title}: " + ", ".join(f"{KEY_MAPPING[KEY_BY_CODE[code]]}={count}" for count, code in ranked))
+    chords = sorted((count, index) for index, count in enumerate(usage.chords) if count)[::-1][:10]
+    for count, index in chords:
+        mask, code = divmod(index, USAGE_KEYS)
+        names = [name for bit, name in enumerate(USAGE_MODIFIER_NAMES) if mask & (1 << bit)]
+        print(f"chord {'+'.join(names + [KEY_MAPPING[KEY_BY_CODE[code]]])}: {count}")
+    return 0
+
+
+def replay_trace(path: str) -> int:
+    settings, texts, records = EventTrace.load(path)
+    if not records:
+        print(f"{path}: empty trace")
+        return 0
+
+    device = RecordingDevice()
+    clock = VirtualClock(records[0][0] // 1_000_000)
+    win = MutterBoard(engine=KeyboardEngine(device=device), clock=clock, replay_settings=settings)
+    # 连发与长按的触发时刻取自追踪：GLib 按实际派发时间重新计时，逐次推迟，虚拟时钟无法复现
+    clock.scripted = {win._repeat_delay_done, win._repeat_tick, win._enter_space_cursor_mode}
+    buttons: Dict[int, Gtk.Button] = {key[1]: button for key, button in win.modifier_buttons.items()}
+    buttons.update({LABEL_TO_KEY[label][1]: button for label, button in win.regular_buttons.items()})
+
+    for timestamp, kind, code, x, y in records:
+        if kind in (TRACE_EMIT_DOWN, TRACE_EMIT_UP):
+            continue
+        # 先触发此刻之前到期的其他计时器（按键闪烁、剪贴板恢复），再送入事件
+        clock.advance_to(timestamp // 1_000_000)
+        if kind in (TRACE_PRESS, TRACE_RELEASE) and code not in buttons:
+            print(f"{path}: key code {code} is not in the recorded layout")
+            return 1
+        if kind == TRACE_PRESS:
+            win.on_button_press(buttons[code], KEY_BY_CODE[code])
+        elif kind == TRACE_RELEASE:
+            win.on_button_release(buttons[code], KEY_BY_CODE[code])
+        elif kind in (TRACE_CHAR, TRACE_CHAR_REPLACE):
+            win.emit_character(chr(code), replace=kind == TRACE_CHAR_REPLACE)
+        elif kind == TRACE_TEXT and code in texts:
+            win.emit_text(texts[code])
+        elif kind == TRACE_REPEAT_DELAY and code in KEY_BY_CODE:
+            win._repeat_delay_done(KEY_BY_CODE[code])
+        elif kind == TRACE_REPEAT_TICK and code in KEY_BY_CODE:
+            win._repeat_tick(KEY_BY_CODE[code])
+        elif kind == TRACE_CURSOR_MODE:
+            win._enter_space_cursor_mode()
+        elif kind == TRACE_MOTION and win.space_button is not None:
+            event = SimpleNamespace(x=x, y=y, time=code)
+            win.on_space_motion(win.space_button, event)
+    clock.advance_to(records[-1][0] // 1_000_000)
+    win.destroy()
+
+    expected = [
+        (code, 1 if kind == TRACE_EMIT_DOWN else 0)
+        for _, kind, code, _, _ in records
+        if kind in (TRACE_EMIT_DOWN, TRACE_EMIT_UP)
+    ]
+    actual = device.events
+    mismatch = next((i for i, pair in enumerate(zip(expected, actual)) if pair[0] != pair[1]), None)
+    if mismatch is None and len(expected) == len(actual):
+        print(f"{path}: {len(actual)} emissions replayed identically")
+        return 0
+    if mismatch is None:
+        mismatch = min(len(expected), len(actual))
+    print(f"{path}: divergence at emission {mismatch} (recorded {len(expected)}, replayed {len(actual)})")
+    print(f"  recorded: {expected[mismatch:mismatch + 8]}")
+    print(f"  replayed: {actual[mismatch:mismatch + 8]}")
+    return 1
+
+
 if __name__ == "__main__":
-    win = MutterBoard()
+    parser = argparse.ArgumentParser(prog="mutterboard")
+    parser.add_argument("--replay", metavar="TRACE", help="replay a dumped event trace against a recording backend")
+    parser.add_argument("--bench-themes", type=int, metavar="N", help="benchmark theme loading with N user themes")
+    parser.add_argument("--bench-text", type=int, metavar="N", help="benchmark typing and pasting N characters")
+    parser.add_argument("--usage-heatmap", metavar="SVG", help="export recorded key usage as an SVG heatmap")
+    parser.add_argument("--injector", action="store_true", help="run the shared key injector without a window")
+    parser.add_argument("--shared", action="store_true", help="send keys through the shared injector")
+    parser.add_argument(
+        "--backend",
+        choices=("auto", "uinput", "wayland"),
+        default="auto",
+        help="key output backend; auto prefers the wayland virtual keyboard protocol when available",
+    )
+    args = parser.parse_args()
+
+    if args.replay:
+        sys.exit(replay_trace(args.replay))
+    if args.bench_themes:
+        sys.exit(benchmark_themes(args.bench_themes))
+    if args.bench_text:
+        sys.exit(benchmark_text(args.bench_text))
+    if args.usage_heatmap:
+        sys.exit(export_usage_heatmap(os.path.expanduser("~/.cache/mutterboard/usage.bin"), args.usage_heatmap))
+    if args.injector:
+        sys.exit(run_injector(injector_socket_path(), args.backend))
+
+    if args.shared:
+        try:
+            engine = connect_injector(injector_socket_path(), args.backend)
+        except RuntimeError as exc:
+            print(f"mutterboard: {exc}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        engine = KeyboardEngine(device=create_output_device(args.backend))
+    win = MutterBoard(engine=engine)
     win.connect("destroy", Gtk.main_quit)
     win.show_all()
     win.toggle_controls()